@@ -28,12 +28,17 @@
 #  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import functools
+import queue as _queue
+import re
 import threading
-import time
+import weakref
 from collections import defaultdict
+from concurrent.futures import Future, wait
 from typing import Union
 
 from elasticapm.conf import constants
+from elasticapm.utils import compat
 from elasticapm.utils.logging import get_logger
 from elasticapm.utils.module_import import import_string
 from elasticapm.utils.threading import IntervalTimer, ThreadManager
@@ -55,6 +60,12 @@ class MetricsRegistry(ThreadManager):
         self._metricsets = {}
         self._tags = tags or {}
         self._collect_timer = None
+        self._ignore_regex = None
+        self._ignore_regex_patterns = None
+        # worker threads for concurrently collected metricsets, and futures of
+        # collections that didn't finish within their collect cycle
+        self._collect_workers = {}
+        self._pending_collects = {}
         super(MetricsRegistry, self).__init__()
 
     def register(self, metricset: Union[str, type]) -> "MetricSet":
@@ -96,9 +107,89 @@ class MetricsRegistry(ThreadManager):
         if self.client.config.is_recording:
             logger.debug("Collecting metrics")
 
-            for _, metricset in self._metricsets.items():
-                for data in metricset.collect():
-                    self.client.queue(constants.METRICSET, data)
+            queue = self.client.queue
+            event_type = constants.METRICSET
+            cheap, expensive = [], []
+            for metricset in self._metricsets.values():
+                (cheap if metricset.before_collect_is_cheap else expensive).append(metricset)
+            if len(expensive) > 1:
+                # collect expensive metricsets concurrently, so their before_collect costs don't add up
+                futures = self._submit_collect(expensive)
+            else:
+                futures, cheap = [], cheap + expensive
+            for metricset in cheap:
+                # collect each metricset separately, so an error in one of them doesn't lose
+                # the data of the others, which have already been reset when collecting
+                try:
+                    collected = list(metricset.collect())
+                except Exception:
+                    logger.error("Collecting metrics from %s failed", type(metricset).__name__, exc_info=True)
+                    continue
+                for data in collected:
+                    queue(event_type, data)
+            for data in self._collect_futures(futures):
+                queue(event_type, data)
+
+    def _submit_collect(self, metricsets):
+        """
+        Collects the given metricsets concurrently, each in its own worker thread
+
+        :param metricsets: a list of metricsets
+        :return: a list of (metricset, future) tuples, the result of each future is a list of collected data
+        """
+        futures = []
+        for metricset in metricsets:
+            worker = self._collect_workers.get(metricset)
+            pending = self._pending_collects.pop(metricset, None)
+            if pending is not None:
+                if pending.done():
+                    # a collection that timed out in a previous cycle has finished in the meantime,
+                    # use its result for this cycle instead of collecting again
+                    futures.append((metricset, pending))
+                    continue
+                elif worker is not None and worker.is_alive():
+                    # never run two collections of the same metricset at the same time
+                    logger.debug("Previous collection of %s still running, skipping", type(metricset).__name__)
+                    self._pending_collects[metricset] = pending
+                    continue
+                # otherwise, the worker is gone (e.g. after forking), and the collection will never finish
+            if worker is None or not worker.is_alive():
+                worker = _CollectWorker(metricset)
+                try:
+                    worker.start()
+                except RuntimeError:
+                    # no new threads can be started during interpreter shutdown, which is when
+                    # we collect one last time if the client is closed from an atexit handler
+                    future = Future()
+                    _collect_into_future(metricset, future)
+                    futures.append((metricset, future))
+                    continue
+                self._collect_workers[metricset] = worker
+            futures.append((metricset, worker.submit()))
+        return futures
+
+    def _collect_futures(self, futures):
+        """
+        Waits for the given futures for at most one collect interval, and yields their collected data.
+        Futures that aren't done by then are kept, and their data is yielded in a later cycle.
+        """
+        if not futures:
+            return
+        timeout = self.collect_interval if self.client.config.metrics_interval else None
+        wait([future for _, future in futures], timeout=timeout)
+        done = []
+        for metricset, future in futures:
+            if future.done():
+                done.append((metricset, future))
+            else:
+                logger.warning("Collecting metrics from %s timed out", type(metricset).__name__)
+                self._pending_collects[metricset] = future
+        for metricset, future in done:
+            exc = future.exception()
+            if exc is not None:
+                logger.error("Collecting metrics from %s failed", type(metricset).__name__, exc_info=exc)
+            else:
+                yield from future.result()
 
     def start_thread(self, pid=None) -> None:
         super(MetricsRegistry, self).start_thread(pid=pid)
@@ -116,6 +207,10 @@ class MetricsRegistry(ThreadManager):
             self._collect_timer = None
             # collect one last time
             self.collect()
+        for worker in self._collect_workers.values():
+            worker.stop()
+        self._collect_workers = {}
+        self._pending_collects = {}
 
     @property
     def collect_interval(self):
@@ -125,14 +220,34 @@ class MetricsRegistry(ThreadManager):
     def ignore_patterns(self):
         return self.client.config.disable_metrics or []
 
+    @property
+    def ignore_regex(self):
+        """
+        All ignore patterns combined into a single regular expression, or None if there are no patterns.
+        The combined expression is rebuilt whenever the configured patterns change.
+        """
+        patterns = self.ignore_patterns
+        if not patterns:
+            return None
+        if patterns is not self._ignore_regex_patterns:
+            self._ignore_regex = _combine_patterns(patterns)
+            self._ignore_regex_patterns = patterns
+        return self._ignore_regex
+
 
 class MetricSet(object):
+    # Set this to False if before_collect does I/O or other slow work. If more than one
+    # metricset does so, they are collected concurrently.
+    before_collect_is_cheap = True
+
     def __init__(self, registry) -> None:
         self._lock = threading.Lock()
         self._counters = {}
         self._gauges = {}
         self._timers = {}
         self._histograms = {}
+        # no-op metrics are kept separately, so collect() never has to look at them
+        self._noop_metrics = {}
         self._registry = registry
         self._label_limit_logged = False
 
@@ -183,25 +298,42 @@ class MetricSet(object):
 
         labels = self._labels_to_key(labels)
         key = (name, labels)
+        # Metrics are never removed, so existing metrics can be looked up without the lock.
+        # The lock is only needed when a new metric might have to be created.
+        metric = container.get(key)
+        if metric is not None:
+            return metric
+        noop_key = (metric_class, name, labels)
+        if noop_key in self._noop_metrics:
+            return noop_metric
         with self._lock:
-            if key not in container:
-                if any(pattern.match(name) for pattern in self._registry.ignore_patterns):
-                    metric = noop_metric
-                elif (
-                    len(self._gauges) + len(self._counters) + len(self._timers) + len(self._histograms)
-                    >= DISTINCT_LABEL_LIMIT
-                ):
-                    if not self._label_limit_logged:
-                        self._label_limit_logged = True
-                        logger.warning(
-                            "The limit of %d metricsets has been reached, no new metricsets will be created."
-                            % DISTINCT_LABEL_LIMIT
-                        )
-                    metric = noop_metric
-                else:
-                    metric = metric_class(name, reset_on_collect=reset_on_collect, unit=unit, **kwargs)
+            # check again, another thread might have created the metric in the meantime
+            metric = container.get(key)
+            if metric is not None:
+                return metric
+            if noop_key in self._noop_metrics:
+                return noop_metric
+            ignore_regex = self._registry.ignore_regex
+            if ignore_regex and ignore_regex.match(name):
+                metric = noop_metric
+            elif (
+                len(self._gauges) + len(self._counters) + len(self._timers) + len(self._histograms)
+                >= DISTINCT_LABEL_LIMIT
+            ):
+                if not self._label_limit_logged:
+                    self._label_limit_logged = True
+                    logger.warning(
+                        "The limit of %d metricsets has been reached, no new metricsets will be created."
+                        % DISTINCT_LABEL_LIMIT
+                    )
+                metric = noop_metric
+            else:
+                metric = metric_class(name, reset_on_collect=reset_on_collect, unit=unit, **kwargs)
+            if metric is noop_metric:
+                self._noop_metrics[noop_key] = metric
+            else:
                 container[key] = metric
-            return container[key]
+            return metric
 
     def collect(self):
         """
@@ -216,68 +348,77 @@ class MetricSet(object):
             }
         """
         self.before_collect()
-        timestamp = int(time.time() * 1000000)
+        # take a snapshot of the metrics to avoid threading issues (see #717), and release
+        # the lock before reading the values, so metric creation isn't blocked while collecting
+        with self._lock:
+            counters = list(self._counters.items())
+            gauges = list(self._gauges.items())
+            timers = list(self._timers.items())
+            histograms = list(self._histograms.items())
+        if not (counters or gauges or timers or histograms):
+            return
+        timestamp = compat.time_ns() // 1000
         samples = defaultdict(dict)
-        if self._counters:
-            # iterate over a copy of the dict to avoid threading issues, see #717
-            for (name, labels), counter in self._counters.copy().items():
-                if counter is not noop_metric:
-                    val = counter.val
-                    if val or not counter.reset_on_collect:
-                        samples[labels].update({name: {"value": val}})
-                    if counter.reset_on_collect:
-                        counter.reset()
-        if self._gauges:
-            for (name, labels), gauge in self._gauges.copy().items():
-                if gauge is not noop_metric:
-                    val = gauge.val
-                    if val or not gauge.reset_on_collect:
-                        samples[labels].update({name: {"value": val, "type": "gauge"}})
-                    if gauge.reset_on_collect:
-                        gauge.reset()
-        if self._timers:
-            for (name, labels), timer in self._timers.copy().items():
-                if timer is not noop_metric:
-                    val, count = timer.val
-                    if val or not timer.reset_on_collect:
-                        sum_name = ".sum"
-                        if timer._unit:
-                            sum_name += "." + timer._unit
-                        samples[labels].update({name + sum_name: {"value": val}})
-                        samples[labels].update({name + ".count": {"value": count}})
-                    if timer.reset_on_collect:
-                        timer.reset()
-        if self._histograms:
-            for (name, labels), histo in self._histograms.copy().items():
-                if histo is not noop_metric:
-                    counts = histo.val
-                    if counts or not histo.reset_on_collect:
-                        # For the bucket values, we follow the approach described by Prometheus's
-                        # histogram_quantile function
-                        # (https://prometheus.io/docs/prometheus/latest/querying/functions/#histogram_quantile)
-                        # to achieve consistent percentile aggregation results:
-                        #
-                        # "The histogram_quantile() function interpolates quantile values by assuming a linear
-                        # distribution within a bucket. (...) If a quantile is located in the highest bucket,
-                        # the upper bound of the second highest bucket is returned. A lower limit of the lowest
-                        # bucket is assumed to be 0 if the upper bound of that bucket is greater than 0. In that
-                        # case, the usual linear interpolation is applied within that bucket. Otherwise, the upper
-                        # bound of the lowest bucket is returned for quantiles located in the lowest bucket."
-                        bucket_midpoints = []
-                        for i, bucket_le in enumerate(histo.buckets):
-                            if i == 0:
-                                if bucket_le > 0:
-                                    bucket_le /= 2.0
-                            elif i == len(histo.buckets) - 1:
-                                bucket_le = histo.buckets[i - 1]
-                            else:
-                                bucket_le = histo.buckets[i - 1] + (bucket_le - histo.buckets[i - 1]) / 2.0
-                            bucket_midpoints.append(bucket_le)
-                        samples[labels].update(
-                            {name: {"counts": counts, "values": bucket_midpoints, "type": "histogram"}}
-                        )
-                    if histo.reset_on_collect:
-                        histo.reset()
+        if counters:
+            for (name, labels), counter in counters:
+                val = counter.val
+                reset_on_collect = counter.reset_on_collect
+                if val or not reset_on_collect:
+                    samples[labels][name] = {"value": val}
+                if reset_on_collect:
+                    counter.reset()
+        if gauges:
+            for (name, labels), gauge in gauges:
+                val = gauge.val
+                reset_on_collect = gauge.reset_on_collect
+                if val or not reset_on_collect:
+                    samples[labels][name] = {"value": val, "type": "gauge"}
+                if reset_on_collect:
+                    gauge.reset()
+        if timers:
+            for (name, labels), timer in timers:
+                val, count = timer.val
+                reset_on_collect = timer.reset_on_collect
+                if val or not reset_on_collect:
+                    sum_name = ".sum"
+                    if timer._unit:
+                        sum_name += "." + timer._unit
+                    sample = samples[labels]
+                    sample[name + sum_name] = {"value": val}
+                    sample[name + ".count"] = {"value": count}
+                if reset_on_collect:
+                    timer.reset()
+        if histograms:
+            for (name, labels), histo in histograms:
+                counts = histo.val
+                reset_on_collect = histo.reset_on_collect
+                if counts or not reset_on_collect:
+                    # For the bucket values, we follow the approach described by Prometheus's
+                    # histogram_quantile function
+                    # (https://prometheus.io/docs/prometheus/latest/querying/functions/#histogram_quantile)
+                    # to achieve consistent percentile aggregation results:
+                    #
+                    # "The histogram_quantile() function interpolates quantile values by assuming a linear
+                    # distribution within a bucket. (...) If a quantile is located in the highest bucket,
+                    # the upper bound of the second highest bucket is returned. A lower limit of the lowest
+                    # bucket is assumed to be 0 if the upper bound of that bucket is greater than 0. In that
+                    # case, the usual linear interpolation is applied within that bucket. Otherwise, the upper
+                    # bound of the lowest bucket is returned for quantiles located in the lowest bucket."
+                    buckets = histo.buckets
+                    last_bucket = len(buckets) - 1
+                    bucket_midpoints = []
+                    for i, bucket_le in enumerate(buckets):
+                        if i == 0:
+                            if bucket_le > 0:
+                                bucket_le /= 2.0
+                        elif i == last_bucket:
+                            bucket_le = buckets[i - 1]
+                        else:
+                            bucket_le = buckets[i - 1] + (bucket_le - buckets[i - 1]) / 2.0
+                        bucket_midpoints.append(bucket_le)
+                    samples[labels][name] = {"counts": counts, "values": bucket_midpoints, "type": "histogram"}
+                if reset_on_collect:
+                    histo.reset()
 
         if samples:
             for labels, sample in samples.items():
@@ -301,7 +442,76 @@ class MetricSet(object):
         return data
 
     def _labels_to_key(self, labels):
-        return tuple((k, str(v)) for k, v in sorted(labels.items()))
+        # Only cache label sets with string values. Other values could compare equal across
+        # types (e.g. 1, 1.0 and True) while being stringified differently, or be unhashable.
+        if all(type(v) is str for v in labels.values()):
+            return _frozen_labels_to_key(frozenset(labels.items()))
+        return _items_to_key(labels.items())
+
+
+_SCOPED_FLAGS = (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL), ("x", re.VERBOSE))
+
+
+class _CollectWorker(threading.Thread):
+    """
+    A thread that collects a single metricset whenever requested. It is a daemon thread,
+    so a collection that hangs doesn't block the interpreter from exiting.
+    """
+
+    def __init__(self, metricset) -> None:
+        super(_CollectWorker, self).__init__(name="eapm metrics collect %s" % type(metricset).__name__, daemon=True)
+        self._metricset = metricset
+        self._requests = _queue.Queue()
+
+    def submit(self):
+        """
+        Requests a collection of the metricset
+        :return: a future, with the list of collected data as result
+        """
+        future = Future()
+        self._requests.put(future)
+        return future
+
+    def stop(self) -> None:
+        self._requests.put(None)
+
+    def run(self) -> None:
+        while True:
+            future = self._requests.get()
+            if future is None:
+                return
+            _collect_into_future(self._metricset, future)
+
+
+def _collect_into_future(metricset, future) -> None:
+    try:
+        future.set_result(list(metricset.collect()))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def _combine_patterns(patterns):
+    """
+    Combines a list of compiled patterns into a single alternation. The flags of
+    each pattern are kept by scoping them to its group.
+    """
+    groups = []
+    for pattern in patterns:
+        enabled = "".join(letter for letter, flag in _SCOPED_FLAGS if pattern.flags & flag)
+        disabled = "".join(letter for letter, flag in _SCOPED_FLAGS if not pattern.flags & flag)
+        # "(?imsx-:...)" is invalid, the dash may only be used if at least one flag is disabled
+        groups.append("(?%s%s:%s)" % (enabled, "-" + disabled if disabled else "", pattern.pattern))
+    return re.compile("|".join(groups))
+
+
+@functools.lru_cache(maxsize=4096)
+def _frozen_labels_to_key(labels):
+    return tuple(sorted(labels))
+
+
+def _items_to_key(items):
+    # most label values are strings already, only convert the ones that aren't
+    return tuple((k, v if type(v) is str else str(v)) for k, v in sorted(items))
 
 
 class SpanBoundMetricSet(MetricSet):
@@ -326,7 +536,7 @@ class BaseMetric(object):
 
 
 class Counter(BaseMetric):
-    __slots__ = BaseMetric.__slots__ + ("_lock", "_initial_value", "_val")
+    __slots__ = BaseMetric.__slots__ + ("_lock", "_initial_value", "_val", "_local", "_cells", "_dead_cells")
 
     def __init__(self, name, initial_value=0, reset_on_collect=False, unit=None) -> None:
         """
@@ -337,6 +547,15 @@ class Counter(BaseMetric):
         """
         self._lock = threading.Lock()
         self._val = self._initial_value = initial_value
+        # Every thread increments its own cell, stored in a thread local. As only the owning
+        # thread ever writes to a cell, no lock is needed when incrementing/decrementing.
+        # All cells are registered in self._cells, and summed up when reading the value.
+        # Resetting/setting the value adjusts self._val instead of writing to the cells.
+        # When a thread finishes, its cell is queued in self._dead_cells, and folded into
+        # self._val the next time the lock is held.
+        self._local = threading.local()
+        self._cells = {}
+        self._dead_cells = []
         super(Counter, self).__init__(name, reset_on_collect=reset_on_collect)
 
     def inc(self, delta=1):
@@ -345,8 +564,10 @@ class Counter(BaseMetric):
         :param delta: the amount to increment the counter by
         :returns the counter itself
         """
-        with self._lock:
-            self._val += delta
+        try:
+            self._local.cell.value += delta
+        except AttributeError:
+            self._register_cell().value += delta
         return self
 
     def dec(self, delta=1):
@@ -355,8 +576,10 @@ class Counter(BaseMetric):
         :param delta: the amount to decrement the counter by
         :returns the counter itself
         """
-        with self._lock:
-            self._val -= delta
+        try:
+            self._local.cell.value -= delta
+        except AttributeError:
+            self._register_cell().value -= delta
         return self
 
     def reset(self):
@@ -365,18 +588,57 @@ class Counter(BaseMetric):
         :returns the counter itself
         """
         with self._lock:
-            self._val = self._initial_value
+            self._fold_dead_cells()
+            self._val = self._initial_value - sum(cell.value for cell in self._cells.values())
         return self
 
     @property
     def val(self):
         """Returns the current value of the counter"""
-        return self._val
+        with self._lock:
+            self._fold_dead_cells()
+            return self._val + sum(cell.value for cell in self._cells.values())
 
     @val.setter
     def val(self, value) -> None:
         with self._lock:
-            self._val = value
+            self._fold_dead_cells()
+            self._val = value - sum(cell.value for cell in self._cells.values())
+
+    def _register_cell(self):
+        """
+        Creates a cell for the current thread. The cell is unregistered once the
+        thread local data of the thread, including the token, is cleaned up.
+        """
+        cell = _CounterCell()
+        token = _CounterCell()
+        with self._lock:
+            self._fold_dead_cells()
+            self._cells[weakref.ref(token, self._unregister_cell)] = cell
+        self._local.cell = cell
+        self._local.token = token
+        return cell
+
+    def _unregister_cell(self, token_ref) -> None:
+        # This weakref callback can run at any point, e.g. during garbage collection while
+        # the lock is held, so the cell is only queued here. list.append is atomic.
+        self._dead_cells.append(token_ref)
+
+    def _fold_dead_cells(self) -> None:
+        """
+        Folds the cells of finished threads into the base value. Must be called with the lock held.
+        """
+        while self._dead_cells:
+            cell = self._cells.pop(self._dead_cells.pop(), None)
+            if cell is not None:
+                self._val += cell.value
+
+
+class _CounterCell(object):
+    __slots__ = ("value", "__weakref__")
+
+    def __init__(self) -> None:
+        self.value = 0
 
 
 class Gauge(BaseMetric):
@@ -414,9 +676,14 @@ class Timer(BaseMetric):
         super(Timer, self).__init__(name, reset_on_collect=reset_on_collect)
 
     def update(self, duration, count=1) -> None:
-        with self._lock:
+        # acquire/release the lock explicitly instead of using a with block, as this is a hot path
+        lock = self._lock
+        lock.acquire()
+        try:
             self._val += duration
             self._count += count
+        finally:
+            lock.release()
 
     def reset(self) -> None:
         with self._lock:
@@ -452,8 +719,12 @@ class Histogram(BaseMetric):
         pos = 0
         while value > self._buckets[pos]:
             pos += 1
-        with self._lock:
+        lock = self._lock
+        lock.acquire()
+        try:
             self._counts[pos] += count
+        finally:
+            lock.release()
 
     @property
     def val(self):
@@ -481,6 +752,8 @@ class NoopMetric(object):
     Note that even when using a no-op metric, the value itself will still be calculated.
     """
 
+    __slots__ = ()
+
     def __init__(self, label, initial_value=0) -> None:
         return
 
@@ -73,6 +73,8 @@ class CGroupFiles(object):
 
 
 class CPUMetricSet(MetricSet):
+    before_collect_is_cheap = False
+
     def __init__(
         self,
         registry,
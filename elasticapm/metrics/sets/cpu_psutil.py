@@ -37,6 +37,8 @@ except ImportError:
 
 
 class CPUMetricSet(MetricSet):
+    before_collect_is_cheap = False
+
     def __init__(self, registry) -> None:
         psutil.cpu_percent(interval=None)
         self._process = psutil.Process()
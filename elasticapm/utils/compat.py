@@ -33,6 +33,7 @@
 import atexit
 import functools
 import platform
+import time
 from typing import TypeVar
 
 _AnnotatedFunctionT = TypeVar("_AnnotatedFunctionT")
@@ -114,3 +115,11 @@ except (ImportError, AttributeError):
 
     def postfork(f):
         return f
+
+
+try:
+    from time import time_ns
+except ImportError:
+    # Python 3.6
+    def time_ns():
+        return int(time.time() * 1000000000)
@@ -43,6 +43,9 @@ class IntervalTimer(threading.Thread):
     A timer that runs a function repeatedly. In contrast to threading.Timer,
     IntervalTimer runs the given function in perpetuity or until it is cancelled.
     When run, it will wait `interval` seconds until the first execution.
+
+    Waiting and measuring the execution time of the function both use monotonic
+    clocks, so adjustments of the system clock don't affect the schedule.
     """
 
     def __init__(
@@ -51,7 +54,7 @@ class IntervalTimer(threading.Thread):
         """
 
         :param function: the function to run
-        :param interval: the interval in-between invocations of the function, in milliseconds
+        :param interval: the interval in-between invocations of the function, in seconds
         :param name: name of the thread
         :param args: arguments to call the function with
         :param kwargs: keyword arguments to call the function with
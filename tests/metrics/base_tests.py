@@ -29,6 +29,11 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
+import re
+import subprocess
+import sys
+import textwrap
+import threading
 import time
 from multiprocessing.dummy import Pool
 
@@ -36,7 +41,15 @@ import mock
 import pytest
 
 from elasticapm.conf import constants
-from elasticapm.metrics.base_metrics import Counter, Gauge, MetricSet, MetricsRegistry, NoopMetric, Timer
+from elasticapm.metrics.base_metrics import (
+    Counter,
+    Gauge,
+    MetricSet,
+    MetricsRegistry,
+    NoopMetric,
+    Timer,
+    _combine_patterns,
+)
 from tests.utils import assert_any_record_contains
 
 
@@ -222,3 +235,315 @@ def test_metrics_not_collected_if_zero_and_reset(elasticapm_client):
 def test_underscore_metrics_deprecation(elasticapm_client):
     with pytest.warns(DeprecationWarning):
         elasticapm_client._metrics
+
+
+def test_metrics_counter_inc_by_one_and_delta(elasticapm_client):
+    counter = Counter("x")
+    for i in range(5):
+        counter.inc()
+    counter.inc(10)
+    assert counter.val == 15
+    assert counter.val == 15
+    counter.inc().dec(3)
+    assert counter.val == 13
+    counter.reset()
+    assert counter.val == 0
+    counter.inc()
+    counter.val = 7
+    assert counter.val == 7
+    counter.inc()
+    assert counter.val == 8
+
+
+def test_metrics_counter_sharded_by_thread(elasticapm_client):
+    counter = Counter("x")
+    pool = Pool(5)
+
+    def target():
+        for i in range(1000):
+            counter.inc()
+        counter.dec(500)
+
+    [pool.apply_async(target, ()) for i in range(10)]
+    pool.close()
+    pool.join()
+    assert counter.val == 5000
+    counter.reset()
+    assert counter.val == 0
+
+
+def test_metrics_labels_key_independent_of_order(elasticapm_client):
+    metricset = MetricSet(MetricsRegistry(elasticapm_client))
+    counter = metricset.counter("x", a="1", b=2)
+    assert metricset.counter("x", b="2", a=1) is counter
+    assert metricset.counter("x", a="1", b="3") is not counter
+    assert metricset._labels_to_key({"b": 2, "a": "1"}) == (("a", "1"), ("b", "2"))
+    assert metricset._labels_to_key({"a": ["unhashable"]}) == (("a", "['unhashable']"),)
+
+
+@mock.patch("elasticapm.metrics.base_metrics.DISTINCT_LABEL_LIMIT", 1)
+def test_noop_metrics_not_collected(elasticapm_client):
+    m = MetricSet(MetricsRegistry(elasticapm_client))
+    m.counter("counter").inc()
+    noop = m.counter("counter", some_label="a")
+    assert isinstance(noop, NoopMetric)
+    assert m.counter("counter", some_label="a") is noop
+    assert isinstance(m.gauge("counter"), NoopMetric)
+    assert list(m._counters.values()) == [m.counter("counter")]
+    data = list(m.collect())
+    assert len(data) == 1
+    assert data[0]["samples"] == {"counter": {"value": 1}}
+
+
+@pytest.mark.parametrize(
+    "elasticapm_client",
+    [{"disable_metrics": "a.*,(?-i)*C"}],
+    indirect=True,
+)
+def test_disable_metrics_combined_regex(elasticapm_client):
+    registry = MetricsRegistry(elasticapm_client)
+    ignore_regex = registry.ignore_regex
+    assert ignore_regex.match("A.b")
+    assert ignore_regex.match("xC")
+    assert not ignore_regex.match("xc")
+    assert not ignore_regex.match("b")
+    assert registry.ignore_regex is ignore_regex
+    elasticapm_client.config.update(version="2", disable_metrics="b")
+    assert registry.ignore_regex.match("b")
+    assert not registry.ignore_regex.match("A.b")
+    # all scoped flags set
+    all_flags = re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+    combined = _combine_patterns([re.compile("a b", all_flags), re.compile("c")])
+    assert combined.match("AB")
+    assert combined.match("c")
+    assert not combined.match("C")
+
+
+def test_metrics_counter_keeps_value_of_finished_threads(elasticapm_client):
+    counter = Counter("x")
+
+    def target():
+        counter.inc(5)
+
+    threads = [threading.Thread(target=target) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc()
+    assert counter.val == 26
+    counter.reset()
+    assert counter.val == 0
+    counter.inc()
+    assert counter.val == 1
+
+
+class SlowMetricSet(MetricSet):
+    before_collect_is_cheap = False
+    barrier = threading.Barrier(2, timeout=5)
+
+    def before_collect(self):
+        # only passes if two slow metricsets are collected at the same time
+        self.barrier.wait()
+        self.gauge("slow").val = 1
+
+
+class OtherSlowMetricSet(SlowMetricSet):
+    pass
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"metrics_interval": "30s"}], indirect=True)
+def test_metrics_registry_collects_expensive_metricsets_concurrently(elasticapm_client):
+    registry = MetricsRegistry(elasticapm_client)
+    registry.register(SlowMetricSet)
+    registry.register(OtherSlowMetricSet)
+    registry.register(DummyMetricSet)
+    registry.collect()
+    metricsets = elasticapm_client.events[constants.METRICSET]
+    assert len(metricsets) == 3
+    assert sum(1 for metricset in metricsets if "slow" in metricset["samples"]) == 2
+
+
+def test_metrics_empty_metricset_collects_nothing(elasticapm_client):
+    m = MetricSet(MetricsRegistry(elasticapm_client))
+    with mock.patch("elasticapm.utils.compat.time_ns", wraps=time.time_ns) as mock_time_ns:
+        assert list(m.collect()) == []
+        assert mock_time_ns.call_count == 0
+        m.counter("x")
+        assert len(list(m.collect())) == 1
+        assert mock_time_ns.call_count == 1
+
+
+def test_metrics_counter_reset_concurrently_with_increments(elasticapm_client):
+    counter = Counter("x", reset_on_collect=True)
+
+    class Delta(int):
+        def __radd__(self, other):
+            # reset from "another thread" right between loading and storing the cell value
+            counter.reset()
+            return other + int(self)
+
+    counter.inc(5)
+    counter.reset()
+    counter.inc(Delta(1))
+    assert counter.val == 1
+    counter.reset()
+
+    iterations = 20000
+    done = threading.Event()
+
+    def target():
+        for i in range(iterations):
+            counter.inc()
+        done.set()
+
+    reported = 0
+    thread = threading.Thread(target=target)
+    thread.start()
+    while not done.is_set():
+        reported += counter.val
+        counter.reset()
+    thread.join()
+    reported += counter.val
+    assert reported <= iterations
+
+
+def test_metrics_counter_cell_unregistered_while_lock_held(elasticapm_client):
+    counter = Counter("x")
+    counter.inc(3)
+    token_ref = next(iter(counter._cells))
+    with counter._lock:
+        # e.g. the weakref callback of a finished thread running during garbage collection
+        counter._unregister_cell(token_ref)
+    assert counter.val == 3
+    assert counter._cells == {}
+
+
+def test_metrics_labels_equal_values_of_different_types(elasticapm_client):
+    metricset = MetricSet(MetricsRegistry(elasticapm_client))
+    metricset.counter("x", code=1).inc()
+    metricset.counter("x", code=True).inc()
+    metricset.counter("x", code="1").inc()
+    data = list(metricset.collect())
+    assert sorted(d["tags"]["code"] for d in data) == ["1", "True"]
+    assert {d["tags"]["code"]: d["samples"]["x"]["value"] for d in data} == {"1": 2, "True": 1}
+
+
+class BlockingMetricSet(MetricSet):
+    before_collect_is_cheap = False
+
+    def __init__(self, registry):
+        super(BlockingMetricSet, self).__init__(registry)
+        self.unblock = threading.Event()
+        self.calls = 0
+
+    def before_collect(self):
+        self.calls += 1
+        self.unblock.wait(5)
+        self.counter("blocking", reset_on_collect=True).inc()
+
+
+class FastExpensiveMetricSet(MetricSet):
+    before_collect_is_cheap = False
+
+    def before_collect(self):
+        self.gauge("fast").val = 1
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"metrics_interval": "30s"}], indirect=True)
+def test_metrics_registry_metricset_slower_than_collect_interval(elasticapm_client, caplog):
+    registry = MetricsRegistry(elasticapm_client)
+    blocking = registry.register(BlockingMetricSet)
+    registry.register(FastExpensiveMetricSet)
+
+    def collected(name):
+        return [m for m in elasticapm_client.events[constants.METRICSET] if name in m["samples"]]
+
+    with mock.patch.object(MetricsRegistry, "collect_interval", new_callable=mock.PropertyMock, return_value=0.05):
+        with caplog.at_level(logging.WARNING, logger="elasticapm.metrics"):
+            registry.collect()
+        assert_any_record_contains(caplog.records, "Collecting metrics from BlockingMetricSet timed out")
+        assert len(collected("fast")) == 1
+        assert not collected("blocking")
+
+        # still running, must not be collected a second time concurrently
+        registry.collect()
+        assert blocking.calls == 1
+        assert len(collected("fast")) == 2
+
+        blocking.unblock.set()
+        registry._pending_collects[blocking].result(timeout=5)
+
+        # the late result is used for this cycle, instead of collecting again
+        registry.collect()
+        assert blocking.calls == 1
+        assert len(collected("blocking")) == 1
+
+        registry.collect()
+        assert blocking.calls == 2
+        assert len(collected("blocking")) == 2
+        assert [m["samples"]["blocking"]["value"] for m in collected("blocking")] == [1, 1]
+
+
+class FailingMetricSet(MetricSet):
+    def before_collect(self):
+        raise ValueError("boom")
+
+
+class FailingExpensiveMetricSet(FailingMetricSet):
+    before_collect_is_cheap = False
+
+
+class ResettingExpensiveMetricSet(MetricSet):
+    before_collect_is_cheap = False
+
+    def before_collect(self):
+        self.counter("resetting", reset_on_collect=True).inc()
+
+
+@pytest.mark.parametrize("elasticapm_client", [{"metrics_interval": "30s"}], indirect=True)
+def test_metrics_registry_error_in_one_metricset_keeps_others(elasticapm_client, caplog):
+    registry = MetricsRegistry(elasticapm_client)
+    registry.register(FailingMetricSet)
+    registry.register(FailingExpensiveMetricSet)
+    registry.register(ResettingExpensiveMetricSet)
+    registry.register(DummyMetricSet)
+    with caplog.at_level(logging.ERROR, logger="elasticapm.metrics"):
+        registry.collect()
+    assert_any_record_contains(caplog.records, "Collecting metrics from FailingMetricSet failed")
+    assert_any_record_contains(caplog.records, "Collecting metrics from FailingExpensiveMetricSet failed")
+    metricsets = elasticapm_client.events[constants.METRICSET]
+    assert [m["samples"]["resetting"]["value"] for m in metricsets if "resetting" in m["samples"]] == [1]
+    assert any("a" in m["samples"] for m in metricsets)
+
+
+def test_metrics_registry_hanging_metricset_does_not_block_exit():
+    script = textwrap.dedent(
+        """
+        import datetime
+        import threading
+
+        import mock
+
+        from elasticapm.metrics.base_metrics import MetricSet, MetricsRegistry
+
+        class HangingMetricSet(MetricSet):
+            before_collect_is_cheap = False
+
+            def before_collect(self):
+                threading.Event().wait(30)
+
+        class OtherMetricSet(MetricSet):
+            before_collect_is_cheap = False
+
+        client = mock.Mock()
+        client.config.metrics_interval = datetime.timedelta(milliseconds=100)
+        registry = MetricsRegistry(client)
+        registry.register(HangingMetricSet)
+        registry.register(OtherMetricSet)
+        registry.collect()
+        """
+    )
+    start = time.time()
+    subprocess.check_call([sys.executable, "-c", script], timeout=20)
+    assert time.time() - start < 10